@@ -61,6 +61,14 @@ from mumble import PSMHandler
     default=False,
     show_default=True,
 )
+@click.option(
+    "--processes",
+    "-p",
+    help="Number of processes to modify PSMs with",
+    type=click.INT,
+    default=1,
+    show_default=True,
+)
 @click.option(
     "--keep_original",
     help="Keep the original PSMs in the modified PSMlist",
@@ -77,6 +85,7 @@ def main(
     output_file,
     filetype_write,
     generate_modified_decoys,
+    processes,
     keep_original,
 ):
     """
@@ -93,6 +102,7 @@ def main(
         psm_file_type=filetype_read,
         generate_modified_decoys=generate_modified_decoys,
         keep_original=keep_original,
+        processes=processes,
     )
     psm_handler.write_modified_psm_list(
         modified_psm_list, output_file=output_file, psm_file_type=filetype_write
@@ -1,22 +1,148 @@
-from copy import deepcopy
+import copy
+import functools
 import logging
 import itertools
-from collections import namedtuple
+import math
+import sys
+from collections import namedtuple, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 from psm_utils.io import read_file, write_file
 from psm_utils import PSMList, PSM, Peptidoform
 from psm_utils.utils import mz_to_mass
 from pyteomics import proforma
 from pyteomics.mass import std_aa_mass, calculate_mass, unimod
-from pyteomics.fasta import IndexedFASTA
+from pyteomics import fasta
 from rich.progress import track
 
 logging.basicConfig(format="[%(asctime)s]%(levelname)s => %(message)s", level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+MODIFICATION_COLUMNS = [
+    "name",
+    "monoisotopic_mass",
+    "classification",
+    "restriction",
+    "residue",
+    "rounded_mass",
+]
+
+Localised_mass_shift = namedtuple("Localised_mass_shift", ["loc", "modification"])
+ModSpec = namedtuple(
+    "ModSpec",
+    [
+        "mass",
+        "n_term_any",
+        "c_term_any",
+        "protein_level",
+        "n_term_residues",
+        "c_term_residues",
+        "anywhere_residues",
+        "anywhere_codes",
+    ],
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _process_tag_tokens(mod):
+    """
+    Cached version of proforma.process_tag_tokens, tags are shared between peptidoforms.
+
+    Args:
+        mod (str): Modification name
+
+    return:
+        proforma.TagBase: Processed modification tag
+    """
+    return proforma.process_tag_tokens(mod)
+
+
+@functools.lru_cache(maxsize=100_000)
+def _calculate_peptide_mass(proforma_sequence):
+    """
+    Cached calculation of the monoisotopic mass of a peptidoform.
+
+    Args:
+        proforma_sequence (str): Peptidoform in ProForma notation
+
+    return:
+        float: Monoisotopic mass of the peptidoform
+    """
+    return calculate_mass(Peptidoform(proforma_sequence).composition)
+
+
+@functools.lru_cache(maxsize=1)
+def _read_unimod_modifications():
+    """
+    Read unimod database to modification columns, cached as parsing unimod is slow.
+
+    return:
+        dict: Dictionary with column name as key and tuple of values as value
+    """
+    unimod_db = unimod.Unimod()
+    # if necesary, make distinction protein and peptide level C-term and N-term modifications
+    position_id_mapper = {
+        2: "anywhere",
+        3: "N-term",
+        4: "C-term",
+        5: "N-term",
+        6: "C-term",
+    }
+
+    modifications = {column: [] for column in MODIFICATION_COLUMNS}
+    for mod in unimod_db.mods:
+        if (
+            not mod.username_of_poster == "unimod"
+        ):  # Do not include user submitted modifications
+            continue
+        name = mod.ex_code_name
+        if not name:
+            name = mod.code_name
+        if ("Xlink" in name) or ("plex" in name):  # Do not include crosslinks
+            continue
+        monoisotopic_mass = mod.monoisotopic_mass
+        for specificity in mod.specificities:
+            classification = specificity.classification
+            if classification == "Isotopic label":  # Do not include isotopic labels
+                continue
+            position = specificity.position_id
+            aa = specificity.amino_acid
+            modifications["name"].append(name)
+            modifications["monoisotopic_mass"].append(monoisotopic_mass)
+            modifications["classification"].append(classification.classification)
+            modifications["restriction"].append(position_id_mapper[position])
+            modifications["residue"].append(aa)
+            modifications["rounded_mass"].append(round(monoisotopic_mass, 0))
+
+    return {column: tuple(values) for column, values in modifications.items()}
+
+
+# PSMHandler used by worker processes of PSMHandler.add_modified_psms
+_worker_psm_handler = None
+
+
+def _init_worker(psm_handler):
+    """
+    Store the PSMHandler in a worker process so it is only sent once per worker.
+
+    Args:
+        psm_handler (PSMHandler): PSMHandler object
+    """
+    global _worker_psm_handler
+    _worker_psm_handler = psm_handler
+
+
+def _batch_modify_in_worker(batch, generate_modified_decoys, keep_original):
+    """
+    Get modified PSMs for a batch of PSMs in a worker process, see PSMHandler._batch_modify.
+    """
+    return _worker_psm_handler._batch_modify(batch, generate_modified_decoys, keep_original)
+
 
 class PSMHandler:
     """Class that contains all information about the input file"""
@@ -66,29 +192,36 @@ class PSMHandler:
 
         return locations
 
-    def _return_mass_shifted_peptidoform(self, modification_tuple, peptidoform) -> Peptidoform:
+    def _return_mass_shifted_peptidoform(
+        self, modification_tuple, peptidoform, existing_locations=None
+    ) -> Peptidoform:
         """
         Apply a modification tuple to a peptidoform.
 
         Args:
             modification_tuple (tuple): Tuple containing the location(int) and the modification name(str)
             peptidoform (psm_utils.Peptidoform): Peptidoform object
+            existing_locations (frozenset, optional): Locations of existing modifications in the peptidoform. Defaults to None.
 
         return:
             psm_utils.Peptidoform: Peptidoform object
         """
 
-        new_peptidoform = deepcopy(peptidoform)
-
-        existing_mod_locations = self._find_mod_locations(new_peptidoform)
+        if existing_locations is None:
+            existing_locations = frozenset(self._find_mod_locations(peptidoform))
         loc, mod = modification_tuple
-        if loc in existing_mod_locations:
+        if loc in existing_locations:
             return None
         else:
+            # Only parsed_sequence is mutated in place, nested tags are shared between peptidoforms
+            new_peptidoform = copy.copy(peptidoform)
+            new_peptidoform.parsed_sequence = list(peptidoform.parsed_sequence)
+            new_peptidoform.properties = dict(peptidoform.properties)
+
             if loc == "N-term":
-                new_peptidoform.properties["n_term"] = [proforma.process_tag_tokens(mod)]
+                new_peptidoform.properties["n_term"] = [_process_tag_tokens(mod)]
             elif loc == "C-term":
-                new_peptidoform.properties["c_term"] = [proforma.process_tag_tokens(mod)]
+                new_peptidoform.properties["c_term"] = [_process_tag_tokens(mod)]
             elif loc == "prepeptide":
                 new_peptidoform.parsed_sequence = [
                     (aa, None) for aa in mod
@@ -118,7 +251,7 @@ class PSMHandler:
                 else:
                     new_peptidoform.parsed_sequence[loc] = (
                         aa,
-                        [proforma.process_tag_tokens(mod)],
+                        [_process_tag_tokens(mod)],
                     )
 
         return new_peptidoform
@@ -137,11 +270,18 @@ class PSMHandler:
         """
         if new_peptidoform is None:
             return
-        copy_psm = deepcopy(psm)
+        copy_psm = copy.copy(psm)
         copy_psm.peptidoform = new_peptidoform
+        # Avoid sharing mutable per-PSM containers with the original PSM
+        for field in ("protein_list", "provenance_data", "metadata", "rescoring_features"):
+            value = getattr(psm, field)
+            if value is not None:
+                setattr(copy_psm, field, copy.copy(value))
         return copy_psm
 
-    def _get_modified_peptidoforms(self, psm, keep_original=False, warn=True) -> list:
+    def _get_modified_peptidoforms(
+        self, psm, keep_original=False, warn=True, candidate_window=None
+    ) -> list:
         """
         Get modified peptidoforms derived from a single PSM.
 
@@ -149,16 +289,20 @@ class PSMHandler:
             psm (psm_utils.PSM): PSM object
             keep_original (bool, optional): Keep the original PSM. Defaults to False.
             warn (bool, optional): Warn if no modifications are found. Defaults to True.
+            candidate_window (tuple, optional): Precomputed candidate modification window. Defaults to None.
 
         return:
             list: List of modified PSMs
         """
         modified_peptidoforms = []
-        modification_list = self.modification_handler.localize_mass_shift(psm)
+        modification_list = self.modification_handler.localize_mass_shift(
+            psm, candidate_window=candidate_window
+        )
         if modification_list:
+            existing_locations = frozenset(self._find_mod_locations(psm.peptidoform))
             for modification_tuple in modification_list:
                 new_proteoform = self._return_mass_shifted_peptidoform(
-                    modification_tuple, psm.peptidoform
+                    modification_tuple, psm.peptidoform, existing_locations
                 )
                 new_psm = self._create_new_psm(
                     psm,
@@ -191,8 +335,37 @@ class PSMHandler:
         )
         return PSMList(psm_list=modified_peptidoforms)
 
+    def _batch_modify(self, batch, generate_modified_decoys=False, keep_original=False) -> list:
+        """
+        Get modified PSMs for a batch of PSMs.
+
+        Args:
+            batch (list): List of tuples with a PSM and its candidate modification window
+            generate_modified_decoys (bool, optional): Generate modified decoys. Defaults to False.
+            keep_original (bool, optional): Keep the original PSMs. Defaults to False.
+
+        return:
+            list: List of modified PSMs (or None) for each PSM in the batch
+        """
+        modified_psms = []
+        for psm, candidate_window in batch:
+            if (psm.is_decoy) & (not generate_modified_decoys):
+                modified_psms.append(None)
+                continue
+            modified_psms.append(
+                self._get_modified_peptidoforms(
+                    psm, keep_original=keep_original, warn=False, candidate_window=candidate_window
+                )
+            )
+        return modified_psms
+
     def add_modified_psms(
-        self, psm_list, psm_file_type="infer", generate_modified_decoys=False, keep_original=False
+        self,
+        psm_list,
+        psm_file_type="infer",
+        generate_modified_decoys=False,
+        keep_original=False,
+        processes=1,
     ) -> PSMList:
         """
         Add modified psms to a psm list
@@ -202,6 +375,7 @@ class PSMHandler:
             psm_file_type (str, optional): Type of the input file to read with PSM_utlis.io.read_file. Defaults to "infer" only used if psm_list is filepath.
             generate_modified_decoys (bool, optional): Generate modified decoys. Defaults to False.
             keep_original (bool, optional): Keep the original PSMs. Defaults to False.
+            processes (int, optional): Number of processes to modify PSMs with, the progress bar then advances per batch of PSMs. Defaults to 1.
 
         return:
             psm_utils.PSMList: PSMList object
@@ -215,20 +389,56 @@ class PSMHandler:
         new_psm_list = []
         num_added_psms = 0
 
-        for psm in track(
-            parsed_psm_list,
-            description="Parsing PSMs in PSMList...",
-            total=len(parsed_psm_list),
-        ):
-            new_psm_list.append(psm)
-            if (psm.is_decoy) & (not generate_modified_decoys):
-                continue
-            new_psms = self._get_modified_peptidoforms(
-                psm, keep_original=keep_original, warn=False
+        # look up candidate modifications for all mass shifts at once
+        mass_shifts = self._precompute_shifts(parsed_psm_list, generate_modified_decoys)
+        lo, hi = self.modification_handler.get_candidate_windows(mass_shifts)
+        psms_with_windows = list(zip(parsed_psm_list, zip(lo.tolist(), hi.tolist())))
+
+        # several batches per process to balance the load, single PSMs for a fine progress bar
+        batch_size = 1
+        if processes > 1:
+            batch_size = max(1, math.ceil(len(psms_with_windows) / (processes * 4)))
+        batches = [
+            psms_with_windows[i : i + batch_size]
+            for i in range(0, len(psms_with_windows), batch_size)
+        ]
+
+        executor = None
+        if processes > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=processes, initializer=_init_worker, initargs=(self,)
+            )
+            batch_results = executor.map(
+                _batch_modify_in_worker,
+                batches,
+                itertools.repeat(generate_modified_decoys),
+                itertools.repeat(keep_original),
+            )
+        else:
+            batch_results = map(
+                self._batch_modify,
+                batches,
+                itertools.repeat(generate_modified_decoys),
+                itertools.repeat(keep_original),
             )
-            if new_psms:
-                num_added_psms += len(new_psms) if not keep_original else len(new_psms) - 1
-                new_psm_list.extend(new_psms)
+
+        try:
+            for batch, batch_result in track(
+                zip(batches, batch_results),
+                description="Parsing PSMs in PSMList...",
+                total=len(batches),
+            ):
+                for (psm, _), new_psms in zip(batch, batch_result):
+                    new_psm_list.append(psm)
+                    if new_psms:
+                        num_added_psms += (
+                            len(new_psms) if not keep_original else len(new_psms) - 1
+                        )
+                        new_psm_list.extend(new_psms)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
         if num_added_psms != 0:
             logger.info(f"Added {num_added_psms} additional modified PSMs")
         else:
@@ -236,29 +446,51 @@ class PSMHandler:
 
         return PSMList(psm_list=new_psm_list)
 
+    @staticmethod
+    def _precompute_shifts(psm_list, generate_modified_decoys=False) -> np.ndarray:
+        """
+        Calculate the mass shift between observed and calculated mass for every PSM.
+
+        Args:
+            psm_list (psm_utils.PSMList): PSMList object
+            generate_modified_decoys (bool, optional): Calculate mass shifts for decoys. Defaults to False.
+
+        return:
+            np.ndarray: Array of mass shifts, NaN for PSMs without precursor m/z or charge and for skipped decoys
+        """
+        mass_shifts = np.full(len(psm_list), np.nan)
+        for i, psm in enumerate(psm_list):
+            # decoys that will not be modified are skipped
+            if psm.is_decoy and not generate_modified_decoys:
+                continue
+            charge = psm.get_precursor_charge()
+            if psm.precursor_mz is None or charge is None:
+                continue
+            mass_shifts[i] = mz_to_mass(psm.precursor_mz, charge) - _calculate_peptide_mass(
+                psm.peptidoform.proforma
+            )
+        return mass_shifts
+
     def parse_psm_list(self, psm_list, psm_file_type="infer") -> PSMList:
         """
         Parse the psm list to get the peptidoform and protein information
 
         Args:
-            psm_list (str, list, PSMList): Path to the psm file, list of PSMs or PSMList object
+            psm_list (str, Path, list, PSMList): Path to the psm file, list of PSMs or PSMList object
             psm_file_type (str, optional): Type of the input file to read with PSM_utlis.io.read_file. Defaults to "infer".
 
         return:
             psm_utils.PSMList: PSMList object
         """
 
-        if type(psm_list) is PSMList:
-            pass
-        elif type(psm_list) is list:
-            psm_list = PSMList(psm_list=psm_list)
-        elif type(psm_list) is str:
+        if isinstance(psm_list, PSMList):
+            return psm_list
+        if isinstance(psm_list, list):
+            return PSMList(psm_list=psm_list)
+        if isinstance(psm_list, (str, Path)):
             self.psm_file_name = Path(psm_list)
-            psm_list = read_file(psm_list, filetype=psm_file_type)
-        elif type(psm_list) is not PSMList:
-            raise TypeError("psm_list should be a path to a file or a PSMList object")
-
-        return psm_list
+            return read_file(psm_list, filetype=psm_file_type)
+        raise TypeError("psm_list should be a path to a file or a PSMList object")
 
     def write_modified_psm_list(self, psm_list, output_file=None, psm_file_type="tsv"):
         """
@@ -314,11 +546,19 @@ class PSMHandler:
             return []
         
         # Clean up any whitespace in DataFrame
-        df = df.map(lambda x: x.strip() if isinstance(x, str) else x)
+        for col in df.select_dtypes(include=["object", "string"]).columns:
+            values = df[col]
+            # .str gives NaN for non-string values in object columns, keep those as they were
+            stripped = values.str.strip()
+            df[col] = stripped.where(stripped.notna(), values)
 
         peptidoforms = [
-            PSM(peptidoform=row["peptidoform"], spectrum_id=row["spectrum_id"], precursor_mz=row["precursor_mz"])
-            for _, row in df.iterrows()
+            PSM(peptidoform=peptidoform, spectrum_id=spectrum_id, precursor_mz=precursor_mz)
+            for peptidoform, spectrum_id, precursor_mz in zip(
+                df["peptidoform"].tolist(),
+                df["spectrum_id"].tolist(),
+                df["precursor_mz"].tolist(),
+            )
         ]
 
         return peptidoforms
@@ -343,110 +583,150 @@ class _ModificationHandler:
             fasta_file (str, optional): Path to the fasta file. Defaults to None.
         """
         # TODO add amino acid variations (mutation) as flag
-        self.get_unimod_database()
+        modifications = self.get_unimod_database()
         if add_aa_combinations:
             if not fasta_file:
                 raise ValueError("Fasta file is required to add amino acid combinations")
-            self._add_amino_acid_combinations(add_aa_combinations)
+            self._add_amino_acid_combinations(modifications, add_aa_combinations)
             self.protein_level_check = True
         else:
             self.protein_level_check = False
+        self.modification_df = pd.DataFrame(modifications, columns=MODIFICATION_COLUMNS)
         self.name_to_mass_residue_dict = self._get_name_to_mass_residue_dict()
-        self.rounded_mass_to_name_dict = self._get_rounded_mass_to_name_dict()
+        self._sorted_masses, self._sorted_mass_to_names = self._get_sorted_mass_to_names()
         self.aa_sub_dict = self._get_aa_sub_dict()
         self.mass_error = mass_error
-        self.fasta_file = IndexedFASTA(fasta_file, label=r"^[\n]?>([\S]*)") if fasta_file else None
+        self.protein_sequence_dict = (
+            self._get_protein_sequence_dict(fasta_file) if fasta_file else None
+        )
+        self._peptide_position_cache = {}
+
+    @staticmethod
+    def _get_protein_sequence_dict(fasta_file):
+        """
+        Read all protein sequences of a fasta file into memory.
+
+        Args:
+            fasta_file (str): Path to the fasta file
+
+        return:
+            dict: Dictionary with protein accession as key and sequence as value
+        """
+        protein_sequence_dict = {}
+        with fasta.read(fasta_file) as reader:
+            for description, sequence in reader:
+                # accession is the first word of the header
+                accession = description.split(maxsplit=1)[0] if description.strip() else ""
+                protein_sequence_dict[accession] = sequence
+        return protein_sequence_dict
 
     def get_unimod_database(self):
         """
-        Read unimod databse to a dataframe.
+        Read unimod database to modification columns.
+
+        return:
+            dict: Dictionary with column name as key and list of values as value
         """
-        unimod_db = unimod.Unimod()
-        # if necesary, make distinction protein and peptide level C-term and N-term modifications
-        position_id_mapper = {
-            2: "anywhere",
-            3: "N-term",
-            4: "C-term",
-            5: "N-term",
-            6: "C-term",
+        return {column: list(values) for column, values in _read_unimod_modifications().items()}
+
+    def _get_name_to_mass_residue_dict(self):
+        """
+        Get dictionary with name as key and mass and localisation specification as value
+
+        return:
+            dict: Dictionary with name as key and ModSpec as value
+        """
+        grouped = defaultdict(lambda: ([], []))
+        for name, mass, residue, restriction in zip(
+            self.modification_df["name"].tolist(),
+            self.modification_df["monoisotopic_mass"].tolist(),
+            self.modification_df["residue"].tolist(),
+            self.modification_df["restriction"].tolist(),
+        ):
+            residues, restrictions = grouped[(mass, name)]
+            residues.append(residue)
+            restrictions.append(restriction)
+
+        # Names can be shared by a Unimod entry and an amino acid combination, residues of
+        # different masses are never merged and the heaviest entry is kept for the name
+        return {
+            name: self._get_mod_spec(mass, residues, restrictions)
+            for (mass, name), (residues, restrictions) in sorted(grouped.items())
         }
 
-        modifications = []
-        for mod in unimod_db.mods:
-            if (
-                not mod.username_of_poster == "unimod"
-            ):  # Do not include user submitted modifications
-                continue
-            name = mod.ex_code_name
-            if not name:
-                name = mod.code_name
-            if ("Xlink" in name) or ("plex" in name):  # Do not include crosslinks
-                continue
-            monoisotopic_mass = mod.monoisotopic_mass
-            for specificity in mod.specificities:
-                classification = specificity.classification
-                if classification == "Isotopic label":  # Do not include isotopic labels
-                    continue
-                position = specificity.position_id
-                aa = specificity.amino_acid
-                modifications.append(
-                    {
-                        "name": name,
-                        "monoisotopic_mass": monoisotopic_mass,
-                        "classification": classification.classification,
-                        "restriction": position_id_mapper[position],
-                        "residue": aa,
-                        "rounded_mass": round(monoisotopic_mass, 0),
-                    }
-                )
+    @staticmethod
+    def _get_mod_spec(mass, residue_list, restrictions) -> ModSpec:
+        """
+        Precompute where a modification can be localised from its residues and restrictions
+
+        Args:
+            mass (float): Monoisotopic mass of the modification
+            residue_list (list): List of residues
+            restrictions (list): List of restrictions
 
-        self.modification_df = pd.DataFrame(
-            modifications,
-            columns=[
-                "name",
-                "monoisotopic_mass",
-                "classification",
-                "restriction",
-                "residue",
-                "rounded_mass",
-            ],
+        return:
+            ModSpec: Localisation specification of the modification
+        """
+        n_term_any = c_term_any = protein_level = False
+        n_term_residues, c_term_residues, anywhere_residues = set(), set(), set()
+
+        for residue, restriction in zip(residue_list, restrictions):
+            if residue == "N-term":
+                n_term_any = True
+            elif residue == "C-term":
+                c_term_any = True
+            elif residue == "protein_level":
+                protein_level = True
+            elif restriction == "N-term":
+                n_term_residues.add(sys.intern(residue))
+            elif restriction == "C-term":
+                c_term_residues.add(sys.intern(residue))
+            else:
+                anywhere_residues.add(sys.intern(residue))
+
+        return ModSpec(
+            mass,
+            n_term_any,
+            c_term_any,
+            protein_level,
+            frozenset(n_term_residues),
+            frozenset(c_term_residues),
+            frozenset(anywhere_residues),
+            np.array([ord(residue) for residue in sorted(anywhere_residues)], dtype=np.uint8),
         )
 
-    def _get_name_to_mass_residue_dict(self):
+    @staticmethod
+    def _get_residue_array(peptidoform) -> np.ndarray:
         """
-        Get dictionary with name as key and mass and residue as value
+        Get the residues of a peptide as ASCII codes, modified residues are set to 0
+
+        Args:
+            peptidoform (psm_utils.Peptidoform): Peptidoform object
 
         return:
-            dict: Dictionary with name as key and mass and residue as value
+            np.ndarray: Array of ASCII codes
         """
-        Modification = namedtuple("modification", ["mass", "residues", "restrictions"])
-
-        return {
-            row.name: Modification(row.monoisotopic_mass, row.residue, row.restriction)
-            for row in self.modification_df.groupby(["monoisotopic_mass", "name"])
-            .agg({"residue": list, "restriction": list})
-            .reset_index()
-            .itertuples()
-        }  # TODO: used named tuple here
+        residues = "".join(
+            aa if mods is None else "\0" for aa, mods in peptidoform.parsed_sequence
+        )
+        return np.frombuffer(residues.encode("ascii"), dtype=np.uint8)
 
-    def _get_rounded_mass_to_name_dict(self):
+    def _get_sorted_mass_to_names(self):
         """
-        Get dictionary with rounded mass as key and name as value
+        Get sorted array of modification masses and a parallel list with the names for each mass
 
         return:
-            dict: Dictionary with rounded mass as key and name as value
+            tuple: Sorted numpy array of masses and list of modification names per mass
         """
+        mass_to_names = defaultdict(list)
+        for name, modification in self.name_to_mass_residue_dict.items():
+            mass_to_names[modification.mass].append(name)
+        sorted_masses = sorted(mass_to_names)
 
-        return {
-            row.rounded_mass: row.name
-            for row in self.modification_df.groupby("rounded_mass")
-            .agg({"name": set})
-            .reset_index()
-            .itertuples()
-        }
+        return np.asarray(sorted_masses, dtype=float), [mass_to_names[m] for m in sorted_masses]
 
     def get_localisation(
-        self, psm, modification_name, residue_list, restrictions
+        self, psm, modification_name, mod_spec, residue_array=None
     ) -> list[namedtuple]:
         """
         Localise a given modification in a peptide
@@ -454,97 +734,102 @@ class _ModificationHandler:
         Args:
             psm (psm_utils.PSM): PSM object
             modification_name (str): Name of the modification
-            residue_list (list): List of residues
-            restrictions (list): List of restrictions
+            mod_spec (ModSpec): Localisation specification of the modification
+            residue_array (np.ndarray, optional): Residue array of the peptide, see _get_residue_array. Defaults to None.
 
             return:
                 list: List of localised mass shifts
         """
         loc_list = []
-        Localised_mass_shift = namedtuple("Localised_mass_shift", ["loc", "modification"])
+        parsed_sequence = psm.peptidoform.parsed_sequence
+        properties = psm.peptidoform.properties
 
-        amino_acids_peptide = [x[0] for x in psm.peptidoform.parsed_sequence]
+        if properties["n_term"] is None and (
+            mod_spec.n_term_any or parsed_sequence[0][0] in mod_spec.n_term_residues
+        ):
+            loc_list.append(Localised_mass_shift("N-term", modification_name))
 
-        for residue, restriction in zip(residue_list, restrictions):
-            if (residue == "N-term") and (psm.peptidoform.properties["n_term"] is None):
-                loc_list.append(Localised_mass_shift("N-term", modification_name))
+        if properties["c_term"] is None and (
+            mod_spec.c_term_any or parsed_sequence[-1][0] in mod_spec.c_term_residues
+        ):
+            loc_list.append(Localised_mass_shift("C-term", modification_name))
+
+        if mod_spec.anywhere_codes.size:
+            if residue_array is None:
+                residue_array = self._get_residue_array(psm.peptidoform)
+            loc_list.extend(
+                [
+                    Localised_mass_shift(int(i), modification_name)
+                    for i in np.flatnonzero(np.isin(residue_array, mod_spec.anywhere_codes))
+                ]
+            )
 
-            elif residue == "C-term" and (psm.peptidoform.properties["c_term"] is None):
-                loc_list.append(Localised_mass_shift("C-term", modification_name))
+        if mod_spec.protein_level:
+            loc_list.extend(
+                [
+                    Localised_mass_shift(loc, mod)
+                    for loc, mod in self.check_protein_level(psm, modification_name)
+                ]
+            )
 
-            elif residue == "protein_level":
-                loc_list.extend(
-                    [
-                        Localised_mass_shift(loc, mod)
-                        for loc, mod in self.check_protein_level(psm, modification_name)
-                    ]
-                )
-            elif restriction == "N-term" or restriction == "C-term":
-                if (
-                    restriction == "N-term"
-                    and (psm.peptidoform.properties["n_term"] is None)
-                    and (psm.peptidoform.parsed_sequence[0][0] == residue)
-                ):
-                    loc_list.append(Localised_mass_shift("N-term", modification_name))
-
-                elif (
-                    restriction == "C-term"
-                    and (psm.peptidoform.properties["c_term"] is None)
-                    and (psm.peptidoform.parsed_sequence[-1][0] == residue)
-                ):
-                    loc_list.append(Localised_mass_shift("C-term", modification_name))
+        return loc_list
 
-                else:
-                    continue
-
-            elif residue in amino_acids_peptide:
-                loc_list.extend(
-                    [
-                        Localised_mass_shift(i, modification_name)
-                        for i, aa in enumerate(amino_acids_peptide)
-                        if (aa == residue) and (psm.peptidoform.parsed_sequence[i][1] is None)
-                    ]
-                )
+    def get_candidate_windows(self, mass_shifts):
+        """
+        Get the range of modification masses within the mass error of one or more mass shifts
 
-        return loc_list
+        Args:
+            mass_shifts (float, np.ndarray): Mass shift(s)
 
-    def localize_mass_shift(self, psm) -> list[namedtuple]:
+        return:
+            tuple: Start and stop indices into the sorted modification masses
+        """
+        lo = np.searchsorted(self._sorted_masses, mass_shifts - self.mass_error, side="right")
+        hi = np.searchsorted(self._sorted_masses, mass_shifts + self.mass_error, side="left")
+        return lo, hi
+
+    def localize_mass_shift(self, psm, candidate_window=None) -> list[namedtuple]:
         """Give potential localisations of a mass shift in a peptide
 
         Args:
             psm (psm_utils.PSM): PSM object
+            candidate_window (tuple, optional): Precomputed start and stop indices from get_candidate_windows. Defaults to None.
 
         return:
             list: List of localised mass shifts
         """
 
-        expmass = mz_to_mass(psm.precursor_mz, psm.get_precursor_charge())
-        calcmass = calculate_mass(psm.peptidoform.composition)
-        mass_shift = expmass - calcmass
-
-        # get all potential modifications
-        try:
-            potential_modifications = self.rounded_mass_to_name_dict[round(mass_shift, 0)]
-        except KeyError:
-            return None
-        localized_modifications = []
-        for potential_mod in potential_modifications:
+        if candidate_window is None:
+            expmass = mz_to_mass(psm.precursor_mz, psm.get_precursor_charge())
+            calcmass = _calculate_peptide_mass(psm.peptidoform.proforma)
+            mass_shift = expmass - calcmass
 
-            if (
-                self.name_to_mass_residue_dict[potential_mod].mass - self.mass_error
+            # skip the lookup for mass shifts outside the range of all modification masses
+            if not (
+                self._sorted_masses[0] - self.mass_error
                 < mass_shift
-                < self.name_to_mass_residue_dict[potential_mod].mass + self.mass_error
+                < self._sorted_masses[-1] + self.mass_error
             ):
+                return None
+            candidate_window = self.get_candidate_windows(mass_shift)
+
+        # get all potential modifications within the mass error window
+        lo, hi = candidate_window
+        if lo == hi:
+            return None
+
+        localized_modifications = []
+        residue_array = self._get_residue_array(psm.peptidoform)
+        for potential_mods in self._sorted_mass_to_names[lo:hi]:
+            for potential_mod in potential_mods:
                 localized_mod = self.get_localisation(
                     psm,
                     potential_mod,
-                    self.name_to_mass_residue_dict[potential_mod].residues,
-                    self.name_to_mass_residue_dict[potential_mod].restrictions,
+                    self.name_to_mass_residue_dict[potential_mod],
+                    residue_array=residue_array,
                 )
                 if localized_mod:
                     localized_modifications.extend(localized_mod)
-            else:
-                continue
 
         return localized_modifications if localized_modifications else None
 
@@ -569,36 +854,32 @@ class _ModificationHandler:
         }
         return aa_sub_dict
 
-    def _add_amino_acid_combinations(self, number_of_aa=1):
+    def _add_amino_acid_combinations(self, modifications, number_of_aa=1):
         """
-        Add amino acid masses to the modification dataframe
+        Add amino acid masses to the modification columns
 
         Args:
+            modifications (dict): Modification columns as returned by get_unimod_database
             number_of_aa (int, optional): Number of amino acids to add. Defaults to 1.
         """
-        aa_combinations = []
+        aa_masses = np.round([std_aa_mass[aa] for aa in AMINO_ACIDS], 6)
+        aa_bytes = np.frombuffer(AMINO_ACIDS.encode("ascii"), dtype="S1")
+        names, masses = [], []
         for n in range(1, number_of_aa + 1):
-            aa_combinations.extend(list(itertools.product("ACDEFGHIKLMNPQRSTVWY", repeat=n)))
-        aa_to_mass_dict = {
-            "".join(combo): sum([round(std_aa_mass[aa], 6) for aa in combo])
-            for combo in aa_combinations
-        }
-        self.modification_df = pd.concat(
-            [
-                self.modification_df,
-                pd.DataFrame(
-                    {
-                        "name": name,
-                        "monoisotopic_mass": mass,
-                        "classification": "AA addition",
-                        "residue": "protein_level",
-                        "restriction": "anywhere",
-                        "rounded_mass": round(mass, 0),
-                    }
-                    for name, mass in aa_to_mass_dict.items()
-                ),
-            ]
-        )
+            # index combinations in the same order as itertools.product
+            combo_idx = np.indices((len(AMINO_ACIDS),) * n).reshape(n, -1).T
+            masses.append(aa_masses[combo_idx].sum(axis=1))
+            # view each row of n single characters as one string of length n
+            combo_bytes = np.ascontiguousarray(aa_bytes[combo_idx]).view(f"S{n}").ravel()
+            names.extend(combo_bytes.astype(str).tolist())
+        masses = np.concatenate(masses)
+
+        modifications["name"].extend(names)
+        modifications["monoisotopic_mass"].extend(masses.tolist())
+        modifications["classification"].extend(["AA addition"] * len(names))
+        modifications["restriction"].extend(["anywhere"] * len(names))
+        modifications["residue"].extend(["protein_level"] * len(names))
+        modifications["rounded_mass"].extend(np.round(masses, 0).tolist())
 
     def check_protein_level(self, psm, additional_aa):
         """
@@ -616,21 +897,31 @@ class _ModificationHandler:
             return []
         found_additional_amino_acids = []
 
-        protein_sequence = self.fasta_file[psm.protein_list[0]].sequence
-        peptide_start_position = protein_sequence.find(psm.peptidoform.sequence)
-        peptide_end_position = peptide_start_position + len(psm.peptidoform.sequence)
+        protein_accession = psm.protein_list[0]
+        peptide_sequence = psm.peptidoform.sequence
+        protein_sequence = self.protein_sequence_dict[protein_accession]
+
+        try:
+            peptide_start_position = self._peptide_position_cache[
+                (protein_accession, peptide_sequence)
+            ]
+        except KeyError:
+            peptide_start_position = protein_sequence.find(peptide_sequence)
+            self._peptide_position_cache[(protein_accession, peptide_sequence)] = (
+                peptide_start_position
+            )
+        if peptide_start_position == -1:
+            return []
+        peptide_end_position = peptide_start_position + len(peptide_sequence)
         additional_aa_len = len(additional_aa)
 
-        if (
-            protein_sequence[peptide_start_position - additional_aa_len : peptide_start_position]
-            == additional_aa
+        # Compare in place instead of slicing the protein sequence
+        if peptide_start_position >= additional_aa_len and protein_sequence.startswith(
+            additional_aa, peptide_start_position - additional_aa_len
         ):
             found_additional_amino_acids.append(("prepeptide", additional_aa))
 
-        if (
-            protein_sequence[peptide_end_position : peptide_end_position + additional_aa_len]
-            == additional_aa
-        ):
+        if protein_sequence.startswith(additional_aa, peptide_end_position):
             found_additional_amino_acids.append(("postpeptide", additional_aa))
 
         return found_additional_amino_acids
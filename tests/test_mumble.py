@@ -1,29 +1,113 @@
 import pytest
-from unittest.mock import MagicMock, patch, mock_open
+import numpy as np
+from copy import copy, deepcopy
+from unittest.mock import MagicMock, patch
 import pandas as pd
 from io import StringIO
+from pathlib import Path
 from collections import namedtuple
 from psm_utils import PSMList, PSM, Peptidoform
 from pyteomics import proforma
-from pyteomics.fasta import IndexedFASTA
 
-from mumble.mumble import _ModificationHandler, PSMHandler
+
+# CSV inputs for parse_csv_file, parsed once, whitespace is stripped by parse_csv_file
+_CSV_VALID = (
+    "peptidoform\tspectrum_id\tprecursor_mz\n"
+    "        ART[Deoxy]HR/2\tspec1\t214.1\n"
+    "        ABCD/2\tspec2\t300.2\n"
+)
+_CSV_MISSING_COLUMNS = (
+    "peptidoform\tspectrum_id\n"
+    "        ART[Deoxy]HR\tspec1\n"
+    "        ABCD\tspec2\n"
+)
+_CSV_EMPTY = "peptidoform\tspectrum_id\tprecursor_mz"
+_DF_VALID = pd.read_csv(StringIO(_CSV_VALID), sep="\t")
+_DF_MISSING_COLUMNS = pd.read_csv(StringIO(_CSV_MISSING_COLUMNS), sep="\t")
+_DF_EMPTY = pd.read_csv(StringIO(_CSV_EMPTY), sep="\t")
+# object column with mixed types, as read_csv(low_memory=True) can produce on large files
+_DF_MIXED_TYPES = pd.DataFrame(
+    {
+        "peptidoform": ["  ART[Deoxy]HR/2", "ABCD/2 "],
+        "spectrum_id": pd.Series([1234, " scan=5"], dtype=object),
+        "precursor_mz": [214.1, 300.2],
+    }
+)
+
+# Expected peptidoforms and tags, parsed once
+_PEP_ORIGINAL = Peptidoform("ART[Deoxy]HR")
+_PEP_CARB_LEFT = Peptidoform("AR[Carbamyl]T[Deoxy]HR")
+_PEP_CARB_RIGHT = Peptidoform("ART[Deoxy]HR[Carbamyl]")
+_PEP_SUB = Peptidoform("ART[Deoxy]AR")
+_PEP_VALID_CHARGED = Peptidoform("ART[Deoxy]HR/2")
+_AHX2_HSL_TAG = proforma.process_tag_tokens("Ahx2+Hsl")
+
+# PSMs for localisation tests, parsed once, tests restore any attribute they change
+_PSM_LOCALIZE = PSM(
+    peptidoform="ART[Deoxy]HR/3",
+    spectrum_id="some_spectrum",
+    is_decoy=False,
+    protein_list=["some_protein"],
+    precursor_mz=208.79446854107334,
+)
+_PSM_QARTHRQ = PSM(peptidoform="QART[Deoxy]HRQ/3", spectrum_id="some_spectrum")
+_PSM_KTIE = PSM(peptidoform="KTIEVFDPDADTW/2", spectrum_id="some_spectrum")
+_PSM_ARTHR = PSM(peptidoform="ART[Deoxy]HR/3", spectrum_id="some_spectrum")
+
+Localised_mass_shift = namedtuple("Localised_mass_shift", ["loc", "modification"])
+_EXPECTED_LOCALISATION = [
+    Localised_mass_shift("N-term", "mod1"),  # N-term modification or Q at N-term
+    Localised_mass_shift("C-term", "mod1"),  # C-term modification
+    Localised_mass_shift(2, "mod1"),
+    Localised_mass_shift(5, "mod1"),  # R in the sequence
+    Localised_mass_shift("prepeptide", "mod1"),  # protein level modification
+]
+
+
+@pytest.fixture(scope="session")
+def mumble_syms():
+    # Import mumble lazily, collection should not pay for psm_utils.io, unimod and rich
+    import mumble.mumble
+
+    return mumble.mumble
+
+
+class _StubModHandler:
+    """Lightweight stand-in for _ModificationHandler with the attributes PSMHandler uses."""
+
+    __slots__ = ("aa_sub_dict", "get_candidate_windows", "localize_mass_shift")
+
+    def __init__(self):
+        self.aa_sub_dict = {}
+        self.localize_mass_shift = lambda psm, candidate_window=None: None
+        self.get_candidate_windows = lambda mass_shifts: (
+            np.zeros(len(mass_shifts), dtype=int),
+            np.zeros(len(mass_shifts), dtype=int),
+        )
 
 
 class TestPSMHandler:
 
-    @pytest.fixture
-    def setup_psmhandler(self):
-        # Fixture for setting up PSMHandler with mocked dependencies
+    @pytest.fixture(scope="session")
+    def psmhandler_template(self, mumble_syms):
+        # PSMHandler and PSM are built once, tests work on a shallow copy of the handler
         psm = PSM(
             peptidoform="ART[Deoxy]HR",
             spectrum_id="some_spectrum",
             is_decoy=False,
             protein_list=["some_protein"],
         )
+        psm_handler = mumble_syms.PSMHandler(aa_combinations=0, fasta_file=None, mass_error=0.02)
+
+        return psm_handler, psm
+
+    @pytest.fixture
+    def setup_psmhandler(self, psmhandler_template):
+        # Fixture for setting up PSMHandler with stubbed dependencies
+        template_psm_handler, psm = psmhandler_template
 
-        mod_handler = MagicMock(spec=_ModificationHandler)
-        psm_handler = PSMHandler(aa_combinations=0, fasta_file=None, mass_error=0.02)
+        mod_handler = _StubModHandler()
+        psm_handler = copy(template_psm_handler)
         psm_handler.modification_handler = mod_handler
 
         return psm_handler, mod_handler, psm
@@ -57,9 +141,95 @@ class TestPSMHandler:
         )
 
         assert new_peptidoform_1 is not None
-        assert new_peptidoform_1.properties["c_term"] == [proforma.process_tag_tokens("Ahx2+Hsl")]
+        assert new_peptidoform_1.properties["c_term"] == [_AHX2_HSL_TAG]
+        # processed tags are cached and shared between peptidoforms
+        assert (
+            psm_handler._return_mass_shifted_peptidoform(
+                ("C-term", "Ahx2+Hsl"), psm.peptidoform
+            ).properties["c_term"][0]
+            is new_peptidoform_1.properties["c_term"][0]
+        )
         assert new_peptidoform_2 is not None
-        assert new_peptidoform_2 == Peptidoform("ART[Deoxy]AR")
+        assert new_peptidoform_2 == _PEP_SUB
+
+        # original peptidoform should not be altered
+        assert psm.peptidoform == _PEP_ORIGINAL
+
+        # already modified locations are skipped
+        existing_locations = frozenset(psm_handler._find_mod_locations(psm.peptidoform))
+        assert (
+            psm_handler._return_mass_shifted_peptidoform(
+                (2, "Carbamyl"), psm.peptidoform, existing_locations
+            )
+            is None
+        )
+
+    @pytest.mark.parametrize(
+        "modification_tuple,modify",
+        [
+            pytest.param(
+                ("N-term", "Acetyl"),
+                lambda pep: pep.properties.update(n_term=[proforma.process_tag_tokens("Acetyl")]),
+                id="n_term",
+            ),
+            pytest.param(
+                ("C-term", "Ahx2+Hsl"),
+                lambda pep: pep.properties.update(c_term=[_AHX2_HSL_TAG]),
+                id="c_term",
+            ),
+            pytest.param(
+                (1, "Carbamyl"),
+                lambda pep: pep.parsed_sequence.__setitem__(
+                    1, ("R", [proforma.process_tag_tokens("Carbamyl")])
+                ),
+                id="residue",
+            ),
+            pytest.param(
+                (3, "His->Ala"),
+                lambda pep: pep.parsed_sequence.__setitem__(3, ("A", None)),
+                id="substitution",
+            ),
+            pytest.param(
+                ("prepeptide", "MK"),
+                lambda pep: setattr(
+                    pep, "parsed_sequence", [("M", None), ("K", None)] + pep.parsed_sequence
+                ),
+                id="prepeptide",
+            ),
+        ],
+    )
+    def test_return_mass_shifted_peptidoform_matches_deepcopy(
+        self, setup_psmhandler, modification_tuple, modify
+    ):
+        psm_handler, mod_handler, _ = setup_psmhandler
+        mod_handler.aa_sub_dict = {"His->Ala": ("H", "A")}
+        peptidoform = Peptidoform("ART[Deoxy]HR/3")
+
+        new_peptidoform = psm_handler._return_mass_shifted_peptidoform(
+            modification_tuple, peptidoform
+        )
+
+        # should match modifying a deepcopy of the peptidoform
+        expected_peptidoform = deepcopy(peptidoform)
+        modify(expected_peptidoform)
+        assert new_peptidoform == expected_peptidoform
+        assert new_peptidoform.parsed_sequence == expected_peptidoform.parsed_sequence
+        # ChargeState has no __eq__, the charge is compared through precursor_charge
+        assert new_peptidoform.precursor_charge == expected_peptidoform.precursor_charge
+        assert {k: v for k, v in new_peptidoform.properties.items() if k != "charge_state"} == {
+            k: v for k, v in expected_peptidoform.properties.items() if k != "charge_state"
+        }
+
+        # mutating the copy should not alter the original peptidoform
+        original_sequence = list(peptidoform.parsed_sequence)
+        original_properties = dict(peptidoform.properties)
+        new_peptidoform.parsed_sequence[0] = ("G", None)
+        new_peptidoform.parsed_sequence.append(("K", None))
+        new_peptidoform.properties["n_term"] = ["Oxidation"]
+        new_peptidoform.properties["charge_state"] = None
+        assert peptidoform.parsed_sequence == original_sequence
+        assert peptidoform.properties == original_properties
+        assert peptidoform == Peptidoform("ART[Deoxy]HR/3")
 
     def test_create_new_psm(self, setup_psmhandler):
         psm_handler, _, psm = setup_psmhandler
@@ -70,12 +240,21 @@ class TestPSMHandler:
         assert new_psm is not None
         assert new_psm.peptidoform == new_peptidoform
 
+        # should match a deepcopy of the PSM with the new peptidoform
+        expected_psm = deepcopy(psm)
+        expected_psm.peptidoform = new_peptidoform
+        assert new_psm == expected_psm
+        assert new_psm.protein_list is not psm.protein_list
+        assert psm.peptidoform == _PEP_ORIGINAL
+
     def test_get_modified_peptidoforms(self, setup_psmhandler):
         psm_handler, mod_handler, psm = setup_psmhandler
 
         mod_handler.aa_sub_dict = {"His->Ala": ("H", "A")}
 
-        mod_handler.localize_mass_shift.return_value = [("N-term", "Acetyl")]
+        mod_handler.localize_mass_shift = lambda psm, candidate_window=None: [
+            ("N-term", "Acetyl")
+        ]
         new_psms = psm_handler._get_modified_peptidoforms(psm, keep_original=True)
 
         assert isinstance(new_psms, list)
@@ -83,85 +262,147 @@ class TestPSMHandler:
         assert new_psms[0].peptidoform.properties["n_term"] == ["Acetyl"]
         assert new_psms[1] == psm
 
-        mod_handler.localize_mass_shift.return_value = [(1, "Carbamyl"), (4, "Carbamyl")]
+        mod_handler.localize_mass_shift = lambda psm, candidate_window=None: [
+            (1, "Carbamyl"),
+            (4, "Carbamyl"),
+        ]
         new_psms = psm_handler._get_modified_peptidoforms(psm, keep_original=False)
 
         assert isinstance(new_psms, list)
         assert len(new_psms) == 2
-        assert new_psms[0].peptidoform == Peptidoform("AR[Carbamyl]T[Deoxy]HR")
-        assert new_psms[1].peptidoform == Peptidoform("ART[Deoxy]HR[Carbamyl]")
+        assert new_psms[0].peptidoform == _PEP_CARB_LEFT
+        assert new_psms[1].peptidoform == _PEP_CARB_RIGHT
 
     def test_add_modified_psms(self, setup_psmhandler):
         psm_handler, mod_handler, psm = setup_psmhandler
 
         psm_list = [psm]
-        mod_handler.localize_mass_shift.return_value = [("N-term", "mod1")]
+        mod_handler.get_candidate_windows = lambda mass_shifts: (np.array([0]), np.array([1]))
+        mod_handler.localize_mass_shift = MagicMock(return_value=[("N-term", "mod1")])
         new_psm_list = psm_handler.add_modified_psms(psm_list)
 
         assert isinstance(new_psm_list, PSMList)
         assert len(new_psm_list) > 1
+        mod_handler.localize_mass_shift.assert_called_once_with(psm, candidate_window=(0, 1))
+
+    def test_add_modified_psms_processes(self, psmhandler_template):
+        psm_handler = copy(psmhandler_template[0])
+        psm_list = [
+            PSM(
+                peptidoform="ART[Deoxy]HR/3",
+                spectrum_id=f"spectrum_{i}",
+                is_decoy=i % 3 == 0,
+                precursor_mz=208.79446854107334 + (43.005814 / 3),
+            )
+            for i in range(10)
+        ]
 
-    def test_parse_csv_file_valid(self, setup_psmhandler):
+        new_psm_list = psm_handler.add_modified_psms(psm_list, keep_original=True)
+        new_psm_list_processes = psm_handler.add_modified_psms(
+            psm_list, keep_original=True, processes=2
+        )
 
-        # psm_handler, mod_handler, psm = setup_psmhandler
-        psm_handler = setup_psmhandler[0]
+        assert len(new_psm_list) > len(psm_list)
+        assert [psm.spectrum_id for psm in new_psm_list_processes] == [
+            psm.spectrum_id for psm in new_psm_list
+        ]
+        assert [psm.peptidoform for psm in new_psm_list_processes] == [
+            psm.peptidoform for psm in new_psm_list
+        ]
 
-        # Mock CSV data
-        csv_data = """peptidoform\tspectrum_id\tprecursor_mz
-        ART[Deoxy]HR/2\tspec1\t214.1
-        ABCD/2\tspec2\t300.2
-        """
+    def test_parse_psm_list(self, setup_psmhandler):
+        psm_handler, _, psm = setup_psmhandler
 
-        with patch("builtins.open", mock_open(read_data=csv_data)), \
-            patch("pandas.read_csv", return_value=pd.read_csv(StringIO(csv_data), delimiter="\t")):
-            peptidoforms = psm_handler.parse_csv_file("dummy_file.tsv")
+        psm_list = PSMList(psm_list=[psm])
+        assert psm_handler.parse_psm_list(psm_list) is psm_list
+        assert isinstance(psm_handler.parse_psm_list([psm]), PSMList)
 
-        assert len(peptidoforms) == 2
-        assert peptidoforms[0].peptidoform == Peptidoform("ART[Deoxy]HR/2")
-        assert peptidoforms[0].spectrum_id == "spec1"
-        assert peptidoforms[0].precursor_mz == 214.1
+        with patch("mumble.mumble.read_file", return_value=psm_list) as mock_read_file:
+            assert psm_handler.parse_psm_list(Path("psms.tsv"), psm_file_type="tsv") is psm_list
+        mock_read_file.assert_called_once_with(Path("psms.tsv"), filetype="tsv")
+        assert psm_handler.psm_file_name == Path("psms.tsv")
 
-    def test_parse_csv_file_missing_columns(self, setup_psmhandler):
-        psm_handler = setup_psmhandler[0]
+        with pytest.raises(TypeError):
+            psm_handler.parse_psm_list(psm)
 
-        # Mock CSV data with missing 'precursor_mz' column
-        csv_data = """peptidoform\tspectrum_id
-        ART[Deoxy]HR\tspec1
-        ABCD\tspec2
-        """
+    def test_precompute_shifts(self, setup_psmhandler):
+        psm_handler, _, psm = setup_psmhandler
 
-        with patch("builtins.open", mock_open(read_data=csv_data)), \
-             patch("pandas.read_csv", return_value=pd.read_csv(StringIO(csv_data), delimiter="\t")):
-            peptidoforms = psm_handler.parse_csv_file("dummy_file.tsv", delimiter="\t")
+        psm_list = PSMList(
+            psm_list=[
+                PSM(
+                    peptidoform="ART[Deoxy]HR/3",
+                    spectrum_id="some_spectrum",
+                    precursor_mz=208.79446854107334 + (43.005814 / 3),
+                ),
+                psm,
+            ]
+        )
+        mass_shifts = psm_handler._precompute_shifts(psm_list)
 
-        assert peptidoforms == []  # Should return an empty list due to missing columns
+        assert mass_shifts.shape == (2,)
+        assert mass_shifts[0] == pytest.approx(43.005814, abs=0.02)
+        assert np.isnan(mass_shifts[1])  # no precursor m/z or charge
 
-    def test_parse_csv_file_file_not_found(self, setup_psmhandler):
-        psm_handler = setup_psmhandler[0]
+    def test_add_modified_psms_skipped_decoy(self, psmhandler_template):
+        psm_handler = copy(psmhandler_template[0])
 
-        with patch("builtins.open", side_effect=FileNotFoundError):
-            peptidoforms = psm_handler.parse_csv_file("non_existent_file.tsv", delimiter="\t")
+        # composition of mass-only modifications can not be resolved
+        decoy_psm = PSM(
+            peptidoform="ACDE[+15.9949]K/2",
+            spectrum_id="decoy_spectrum",
+            is_decoy=True,
+            precursor_mz=300.0,
+        )
+        target_psm = PSM(
+            peptidoform="ART[Deoxy]HR/3",
+            spectrum_id="some_spectrum",
+            is_decoy=False,
+            precursor_mz=208.79446854107334,
+        )
+        psm_list = [decoy_psm, target_psm]
 
-        assert peptidoforms == []  # Should return an empty list due to FileNotFoundError
+        mass_shifts = psm_handler._precompute_shifts(PSMList(psm_list=psm_list))
+        assert np.isnan(mass_shifts[0])
+        assert not np.isnan(mass_shifts[1])
 
-    def test_parse_csv_file_empty_file(self, setup_psmhandler):
+        new_psm_list = psm_handler.add_modified_psms(psm_list)
+        assert len(new_psm_list) == 2
+
+    @pytest.mark.parametrize(
+        "csv_frame,side_effect,expected_len",
+        [
+            pytest.param(_DF_VALID, None, 2, id="valid"),
+            pytest.param(_DF_MIXED_TYPES, None, 2, id="mixedtypes"),
+            pytest.param(_DF_MISSING_COLUMNS, None, 0, id="missing"),
+            pytest.param(None, FileNotFoundError, 0, id="notfound"),
+            pytest.param(_DF_EMPTY, None, 0, id="empty"),
+            pytest.param(None, pd.errors.ParserError, 0, id="parsererror"),
+        ],
+    )
+    def test_parse_csv_file(self, setup_psmhandler, csv_frame, side_effect, expected_len):
         psm_handler = setup_psmhandler[0]
 
-        # Mock empty CSV data
-        csv_data = """peptidoform\tspectrum_id\tprecursor_mz"""
-
-        with patch("builtins.open", mock_open(read_data=csv_data)), \
-            patch("pandas.read_csv", return_value=pd.read_csv(StringIO(csv_data), delimiter="\t")):
+        # parse_csv_file strips whitespace in place, so hand it a copy of the shared frame
+        return_value = csv_frame.copy(deep=False) if csv_frame is not None else None
+        with patch("pandas.read_csv", return_value=return_value, side_effect=side_effect):
             peptidoforms = psm_handler.parse_csv_file("dummy_file.tsv", delimiter="\t")
 
-        assert peptidoforms == []  # Should return an empty list due to empty file
+        # Invalid, missing or empty files should return an empty list
+        assert len(peptidoforms) == expected_len
+        if expected_len:
+            assert peptidoforms[0].peptidoform == _PEP_VALID_CHARGED
+            assert peptidoforms[0].precursor_mz == 214.1
+            assert [psm.spectrum_id for psm in peptidoforms] == [
+                str(spectrum_id).strip() for spectrum_id in csv_frame["spectrum_id"]
+            ]
 
 
 class TestModificationHandler:
 
-    @pytest.fixture
-    def setup_modhandler(self):
-        # Fixture for setting up _ModificationHandler
+    @pytest.fixture(scope="session")
+    def modhandler_template(self, mumble_syms):
+        # _ModificationHandler and PSM are built once, tests override attributes with monkeypatch
         psm = PSM(
             peptidoform="ART[Deoxy]HR/3",
             spectrum_id="some_spectrum",
@@ -169,124 +410,141 @@ class TestModificationHandler:
             protein_list=["some_protein"],
             precursor_mz=228.4614,
         )
-        mod_handler = _ModificationHandler(mass_error=0.02)
+        mod_handler = mumble_syms._ModificationHandler(mass_error=0.02)
         return mod_handler, psm
 
-    def test_get_unimod_database(self, setup_modhandler):
+    @pytest.fixture
+    def setup_modhandler(self, modhandler_template):
+        # Fixture for setting up _ModificationHandler
+        return modhandler_template
+
+    def test_get_unimod_database(self, setup_modhandler, mumble_syms):
         mod_handler, _ = setup_modhandler
-        mod_handler.get_unimod_database()
+        modifications = mod_handler.get_unimod_database()
 
-        assert mod_handler.modification_df is not None
+        assert modifications is not None
+        assert len(modifications["name"]) == len(mod_handler.modification_df)
+        assert "Carbamyl" in modifications["name"]
+
+        # parsed unimod database is cached, changes to the returned columns should not leak
+        modifications["name"].append("some_modification")
+        assert mumble_syms._read_unimod_modifications.cache_info().currsize == 1
+        assert mod_handler.get_unimod_database()["name"] == modifications["name"][:-1]
 
     def test_add_amino_acid_combinations(self, setup_modhandler):
         mod_handler, _ = setup_modhandler
 
-        mod_handler._add_amino_acid_combinations(2)
-        assert mod_handler.modification_df is not None
-        assert "YP" in mod_handler.modification_df["name"].values
-        assert "Q" in mod_handler.modification_df["name"].values
-        assert (
-            mod_handler.modification_df[mod_handler.modification_df["name"] == "YP"][
-                "rounded_mass"
-            ].values[0]
-            == 260
-        )
+        modifications = mod_handler.get_unimod_database()
+        mod_handler._add_amino_acid_combinations(modifications, 2)
+        modification_df = pd.DataFrame(modifications)
+        assert modification_df is not None
+        assert len(modification_df) == len(mod_handler.modification_df) + 20 + 20**2
+        assert "YP" in modification_df["name"].values
+        assert "Q" in modification_df["name"].values
+        assert modification_df[modification_df["name"] == "YP"]["rounded_mass"].values[0] == 260
         assert (
-            mod_handler.modification_df[mod_handler.modification_df["name"] == "YP"][
-                "monoisotopic_mass"
-            ].values[0]
+            modification_df[modification_df["name"] == "YP"]["monoisotopic_mass"].values[0]
             == 260.116093
         )
 
-    def test_get_localisation(self, setup_modhandler):
+    @pytest.mark.parametrize(
+        "psm,residue_list,restrictions,expected",
+        [
+            pytest.param(
+                _PSM_QARTHRQ,
+                ["R", "N-term", "C-term", "Q", "protein_level"],
+                ["anywhere", "N-term", "C-term", "N-term", "anywhere"],
+                _EXPECTED_LOCALISATION,
+                id="all_restrictions",
+            ),
+            pytest.param(_PSM_KTIE, ["F"], ["N-term"], [], id="residue_not_at_n_term"),
+            pytest.param(
+                _PSM_ARTHR,
+                ["T", "R"],
+                ["anywhere", "anywhere"],
+                [Localised_mass_shift(1, "mod1"), Localised_mass_shift(4, "mod1")],
+                id="modified_residue_skipped",
+            ),
+        ],
+    )
+    def test_get_localisation(
+        self, setup_modhandler, monkeypatch, psm, residue_list, restrictions, expected
+    ):
         mod_handler, _ = setup_modhandler
 
-        psm = PSM(
-            peptidoform="QART[Deoxy]HRQ/3",
-            spectrum_id="some_spectrum",
-        )
-
-        # Example input data
-        modification_name = "mod1"
-        residue_list = ["R", "N-term", "C-term", "Q", "protein_level"]
-        restrictions = ["anywhere", "N-term", "C-term", "N-term", "anywhere"]
+        mod_spec = mod_handler._get_mod_spec(0.0, residue_list, restrictions)
 
         # Mock the check_protein_level method
-        mod_handler.check_protein_level = MagicMock(return_value=[("prepeptide", "mod1")])
-
-        # Expected output
-        Localised_mass_shift = namedtuple("Localised_mass_shift", ["loc", "modification"])
-        expected_output = [
-            Localised_mass_shift(2, "mod1"),
-            Localised_mass_shift(5, "mod1"),  # R in the sequence
-            Localised_mass_shift("N-term", "mod1"),  # N-term modification
-            Localised_mass_shift("C-term", "mod1"),  # C-term modification
-            Localised_mass_shift("N-term", "mod1"),  # Q in the sequence
-            Localised_mass_shift("prepeptide", "mod1"),  # protein level modification
-        ]
-
-        # Call the method
-        result = mod_handler.get_localisation(psm, modification_name, residue_list, restrictions)
-
-        # Assertions
-        assert result == expected_output
-
-        psm = PSM(
-            peptidoform="KTIEVFDPDADTW/2",
-            spectrum_id="some_spectrum",
+        monkeypatch.setattr(
+            mod_handler,
+            "check_protein_level",
+            MagicMock(return_value=[("prepeptide", "mod1")]),
         )
 
-        # Example input data
-        modification_name = "mod1"
-        residue_list = ["F"]
-        restrictions = ["N-term"]
-
-        # Expected output
-        expected_output = []
-
-        # Call the method
-        result = mod_handler.get_localisation(psm, modification_name, residue_list, restrictions)
+        result = mod_handler.get_localisation(psm, "mod1", mod_spec)
+        residue_array = mod_handler._get_residue_array(psm.peptidoform)
+        result_with_array = mod_handler.get_localisation(
+            psm, "mod1", mod_spec, residue_array=residue_array
+        )
 
-        # Assertions
-        assert result == expected_output
+        assert result == expected
+        assert result_with_array == expected
 
-    def test_localize_mass_shift(self, setup_modhandler):
+    def test_localize_mass_shift(self, setup_modhandler, monkeypatch):
         mod_handler, _ = setup_modhandler
 
-        psm = PSM(
-            peptidoform="ART[Deoxy]HR/3",
-            spectrum_id="some_spectrum",
-            is_decoy=False,
-            protein_list=["some_protein"],
-            precursor_mz=208.79446854107334,
-        )
+        psm = _PSM_LOCALIZE
         orginal_precursor_mz = psm.precursor_mz
-        mod_handler.name_to_mass_residue_dict = {
-            "Carbamyl": namedtuple("Modification", ["mass", "residues", "restrictions"])(
-                43.005814, ["C", "R"], ["anywhere", "anywhere"]
-            ),
-            "Acetyl": namedtuple("Modification", ["mass", "residues", "restrictions"])(
-                42.010565, ["N-term"], ["any N-term"]
-            ),
-        }
-        mod_handler.rounded_mass_to_name_dict = {43.0: ["Carbamyl"], 42.0: ["Acetyl"]}
-
-        psm.precursor_mz = orginal_precursor_mz + (43.005814 / 3)
-        localized_modifications = mod_handler.localize_mass_shift(psm)
-        assert localized_modifications is not None
-        assert localized_modifications[0] == (1, "Carbamyl")
-        assert localized_modifications[1] == (4, "Carbamyl")
-
-        psm.precursor_mz = orginal_precursor_mz + (42.010565 / 3)
-        localized_modifications = mod_handler.localize_mass_shift(psm)
-        assert localized_modifications is not None
-        assert localized_modifications[0] == ("N-term", "Acetyl")
-
-    def test_check_protein_level(self, setup_modhandler):
+        monkeypatch.setattr(
+            mod_handler,
+            "name_to_mass_residue_dict",
+            {
+                "Carbamyl": mod_handler._get_mod_spec(
+                    43.005814, ["C", "R"], ["anywhere", "anywhere"]
+                ),
+                "Acetyl": mod_handler._get_mod_spec(42.010565, ["N-term"], ["any N-term"]),
+            },
+        )
+        sorted_masses, sorted_mass_to_names = mod_handler._get_sorted_mass_to_names()
+        monkeypatch.setattr(mod_handler, "_sorted_masses", sorted_masses)
+        monkeypatch.setattr(mod_handler, "_sorted_mass_to_names", sorted_mass_to_names)
+
+        try:
+            psm.precursor_mz = orginal_precursor_mz + (43.005814 / 3)
+            localized_modifications = mod_handler.localize_mass_shift(psm)
+            assert localized_modifications is not None
+            assert localized_modifications[0] == (1, "Carbamyl")
+            assert localized_modifications[1] == (4, "Carbamyl")
+
+            psm.precursor_mz = orginal_precursor_mz + (42.010565 / 3)
+            localized_modifications = mod_handler.localize_mass_shift(psm)
+            assert localized_modifications is not None
+            assert localized_modifications[0] == ("N-term", "Acetyl")
+
+            # mass shift rounding to a different integer than the modification mass
+            psm.precursor_mz = orginal_precursor_mz + (42.995 / 3)
+            localized_modifications = mod_handler.localize_mass_shift(psm)
+            assert localized_modifications is not None
+            assert localized_modifications[0] == (1, "Carbamyl")
+
+            psm.precursor_mz = orginal_precursor_mz + (44.0 / 3)
+            assert mod_handler.localize_mass_shift(psm) is None
+
+            # mass shift outside the range of all modification masses
+            psm.precursor_mz = orginal_precursor_mz + (1000.0 / 3)
+            assert mod_handler.localize_mass_shift(psm) is None
+            psm.precursor_mz = orginal_precursor_mz - (1000.0 / 3)
+            assert mod_handler.localize_mass_shift(psm) is None
+        finally:
+            psm.precursor_mz = orginal_precursor_mz
+
+    def test_check_protein_level(self, setup_modhandler, monkeypatch):
         mod_handler, psm = setup_modhandler
 
-        mod_handler.fasta_file = MagicMock(IndexedFASTA)
-        mod_handler.fasta_file.__getitem__.return_value.sequence = "RASSLCTPARTHRQVMHUW"
+        monkeypatch.setattr(
+            mod_handler, "protein_sequence_dict", {"some_protein": "RASSLCTPARTHRQVMHUW"}
+        )
+        monkeypatch.setattr(mod_handler, "_peptide_position_cache", {})
 
         additional_aa = "TP"
         results = mod_handler.check_protein_level(psm, additional_aa)
@@ -295,6 +553,53 @@ class TestModificationHandler:
         additional_aa = "Q"
         results = mod_handler.check_protein_level(psm, additional_aa)
         assert ("postpeptide", "Q") in results
+        assert mod_handler._peptide_position_cache[("some_protein", "ARTHR")] == 8
+
+        # additional amino acids longer than the protein N-terminal flank
+        results = mod_handler.check_protein_level(psm, "QRASSLCTP")
+        assert results == []
+
+        # peptide not in protein
+        monkeypatch.setattr(mod_handler, "protein_sequence_dict", {"some_protein": "QARTHQ"})
+        monkeypatch.setattr(mod_handler, "_peptide_position_cache", {})
+        results = mod_handler.check_protein_level(psm, additional_aa)
+        assert results == []
+
+    def test_get_name_to_mass_residue_dict_name_collision(self, tmp_path, mumble_syms):
+        fasta_file = tmp_path / "proteins.fasta"
+        fasta_file.write_text(">some_protein\nMKAAR\n")
+        mod_handler = mumble_syms._ModificationHandler(
+            mass_error=0.02, add_aa_combinations=3, fasta_file=str(fasta_file)
+        )
+
+        # HNE is both a Unimod modification (~156 Da) and an amino acid combination (~380 Da)
+        hne_masses = mod_handler.modification_df.loc[
+            mod_handler.modification_df["name"] == "HNE", "monoisotopic_mass"
+        ]
+        assert hne_masses.nunique() == 2
+
+        # residues of the Unimod entry should not be merged into the combination
+        mod_spec = mod_handler.name_to_mass_residue_dict["HNE"]
+        assert mod_spec.mass == pytest.approx(380.144432)
+        assert mod_spec.protein_level
+        assert not mod_spec.anywhere_residues
+        assert not (mod_spec.n_term_any or mod_spec.c_term_any)
+        assert not (mod_spec.n_term_residues or mod_spec.c_term_residues)
+
+    def test_get_protein_sequence_dict(self, tmp_path, mumble_syms):
+        fasta_file = tmp_path / "proteins.fasta"
+        fasta_file.write_text(
+            ">some_protein some description\nRASSLCTPAR\nTHRQVMHUW\n>other_protein\nMKAAR\n"
+        )
+
+        protein_sequence_dict = mumble_syms._ModificationHandler._get_protein_sequence_dict(
+            str(fasta_file)
+        )
+
+        assert protein_sequence_dict == {
+            "some_protein": "RASSLCTPARTHRQVMHUW",
+            "other_protein": "MKAAR",
+        }
 
 
 if __name__ == "__main__":